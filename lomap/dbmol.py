@@ -546,7 +546,7 @@ class DBMolecules(object):
 
             # process prespecified links now and overwrite the existing info
             if (i, j) in self.prespecified_links and self.prespecified_links[(i, j)] < 0:
-                print(f"Molecule pair {i} {j} forced to be included in the graph - score set to 1")
+                logging.info('Molecule pair %d %d forced to be included in the graph - score set to 1', i, j)
                 strict_mtx[k] = 1.0
                 loose_mtx[k] = 1.0
                 # Note that true_strict_mtx holds the original strict_scr value
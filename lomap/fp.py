@@ -39,6 +39,7 @@ from rdkit import DataStructs
 from rdkit.Chem.Fingerprints import FingerprintMols
 import sys
 import math
+import numpy as np
 from rdkit import RDLogger
 import logging
 import argparse
@@ -48,7 +49,88 @@ import argparse
 # *******************************
 
 
-__all__ = ['FIGUREPRINT']
+__all__ = ['FIGUREPRINT', 'pack_fingerprints', 'bulk_tanimoto']
+
+
+if hasattr(np, 'bitwise_count'):
+    def _popcount_rows(packed):
+        return np.bitwise_count(packed).sum(axis=-1)
+else:
+    # NumPy < 2.0 has no bitwise_count; count set bits per byte through a
+    # 256-entry lookup table instead
+    _BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)],
+                              dtype=np.uint16)
+
+    def _popcount_rows(packed):
+        b = np.ascontiguousarray(packed)
+        b = b.view(np.uint8).reshape(packed.shape[:-1] + (-1,))
+        return _BYTE_POPCOUNT[b].sum(axis=-1)
+
+
+def pack_fingerprints(mols, radius=2, nbits=1024):
+    """
+    Compute a Morgan fingerprint for each passed molecule and pack the
+    bits into a dense (len(mols), nbits/64) uint64 NumPy array. Packing
+    the fingerprints once makes the pairwise Tanimoto calculation a pure
+    popcount problem over machine words (the same layout chemfp uses for
+    its fingerprint arenas)
+
+    Parameters
+    ----------
+
+    mols : list of RDKit molecule objects
+        the molecules to fingerprint
+    radius : int
+        the Morgan fingerprint radius, default 2
+    nbits : int
+        the fingerprint length, default 1024; must be a multiple of 64
+
+    Returns
+    -------
+    packed : numpy array of uint64, shape (len(mols), nbits/64)
+        the bit-packed fingerprints
+    """
+
+    if nbits % 64:
+        raise ValueError('nbits must be a multiple of 64')
+
+    bits = np.zeros((len(mols), nbits), dtype=np.uint8)
+    for i, mol in enumerate(mols):
+        fp = AllChem.GetMorganFingerprintAsBitVect(mol, radius, nBits=nbits)
+        bits[i, fp.GetOnBits()] = 1
+
+    return np.packbits(bits, axis=1).view(np.uint64)
+
+
+def bulk_tanimoto(packed):
+    """
+    Compute the full pairwise Tanimoto similarity matrix for a set of
+    bit-packed fingerprints produced by pack_fingerprints. One row of the
+    matrix is computed per vectorized pass, so the memory use stays
+    linear in the number of molecules
+
+    Parameters
+    ----------
+
+    packed : numpy array of uint64, shape (N, nwords)
+        the bit-packed fingerprints
+
+    Returns
+    -------
+    sims : numpy array of float, shape (N, N)
+        the symmetric Tanimoto similarity matrix
+    """
+
+    n = packed.shape[0]
+    counts = _popcount_rows(packed)
+
+    sims = np.ones((n, n))
+    for i in range(n):
+        common = _popcount_rows(packed[i] & packed)
+        union = counts[i] + counts - common
+        sims[i] = np.divide(common, union, out=np.ones(n), where=union != 0)
+
+    return sims
 
 
 class Figureprint(object):
@@ -59,7 +141,7 @@ class Figureprint(object):
 
     """
 
-    def __init__(self, moli, molj):
+    def __init__(self, moli, molj, verbose='info'):
         """
         Inizialization function
 
@@ -70,8 +152,8 @@ class Figureprint(object):
             the first molecule used to perform the Figureprint calculation
         molj : RDKit molecule object
             the second molecule used to perform the Figureprint calculation
-        options : argparse python object
-            the list of user options
+        verbose : str
+            logging verbosity
 
         """
 
@@ -82,7 +164,7 @@ class Figureprint(object):
         self.moli = moli
         self.molj = molj
 
-        if not options.verbose == 'pedantic':
+        if not verbose == 'pedantic':
             lg = RDLogger.logger()
             lg.setLevel(RDLogger.CRITICAL)
 
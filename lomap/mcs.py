@@ -27,13 +27,91 @@ from rdkit.Chem import AllChem
 from rdkit.Chem.Draw.MolDrawing import DrawingOptions
 from rdkit.Chem import Draw
 from rdkit.Chem import rdmolops
+from rdkit.Chem.Scaffolds import MurckoScaffold
 from rdkit import DataStructs
 from rdkit.Geometry.rdGeometry import Point3D
 
+import concurrent.futures
 import math
+import types
+import weakref
+import numpy as np
 from rdkit import RDLogger
 import logging
 
+# Optional CUDA-accelerated MCS backend. nvMolKit accepts RDKit molecules
+# directly and returns an object with the same smartsString/canceled/
+# numAtoms surface as rdFMCS, so it can be swapped in transparently when
+# it is installed and the caller asks for it.
+try:
+    import nvmolkit.mcs as _nvmcs
+except ImportError:
+    _nvmcs = None
+
+# Optional Numba acceleration for the symmetric-match RMSD kernel below;
+# the NumPy implementation remains as the fallback
+try:
+    from numba import njit as _njit
+except ImportError:
+    _njit = None
+
+if _njit is not None:
+    @_njit(cache=True)
+    def _best_pair_rmsd(coords_i, coords_j):
+        """
+        Given the centred coordinates of all candidate substructure
+        matches for each molecule, as (Ni,k,3) and (Nj,k,3) arrays,
+        return the (i,j) pair with the smallest summed squared distance.
+        Ties resolve to the first pair in row-major order, like the
+        NumPy fallback.
+        """
+        besti = 0
+        bestj = 0
+        best_rmsd = 1e8
+        for i in range(coords_i.shape[0]):
+            for j in range(coords_j.shape[0]):
+                rmsd = 0.0
+                for k in range(coords_i.shape[1]):
+                    for d in range(3):
+                        diff = coords_i[i, k, d] - coords_j[j, k, d]
+                        rmsd += diff * diff
+                if rmsd < best_rmsd:
+                    besti = i
+                    bestj = j
+                    best_rmsd = rmsd
+        return besti, bestj
+    @_njit(cache=True)
+    def _atomic_number_mismatch(ai, aj, diff_table):
+        """
+        Sum the transform-difficulty penalties of the mapped atom pairs
+        whose atomic numbers differ; the compiled counterpart of the
+        NumPy expression in atomic_number_rule_raw
+        """
+        nmismatch = 0.0
+        for k in range(ai.size):
+            if ai[k] != aj[k]:
+                nmismatch += 1.0 - diff_table[ai[k], aj[k]]
+        return nmismatch
+
+    @_njit(cache=True)
+    def _hybridization_mismatch(hybi, hybj, ai, aj):
+        """
+        Flag the mapped atom pairs whose hybridization states differ,
+        keeping the N sp2/sp3 exemption; the compiled counterpart of the
+        mask expression in hybridization_rule_raw
+        """
+        mismatch = np.zeros(hybi.size, dtype=np.bool_)
+        for k in range(hybi.size):
+            if hybi[k] != hybj[k]:
+                if not (ai[k] == 7 and aj[k] == 7
+                        and hybi[k] >= 2 and hybj[k] >= 2):
+                    mismatch[k] = True
+        return mismatch
+else:
+    _best_pair_rmsd = None
+    _atomic_number_mismatch = None
+    _hybridization_mismatch = None
+
 # *******************************
 # Maximum Common Subgraph Class
 # *******************************
@@ -63,6 +141,152 @@ def atom_hybridization(a):
     return 2  # sp2
 
 
+def _ring_membership_arrays(mol):
+    """
+    Build the per-atom ring arrays for a sanitized molecule in a single
+    pass over its ring lists, instead of per-atom IsInRing /
+    IsInRingSize calls: a boolean in-ring array, and a uint8 bitmask per
+    atom with bit k-3 set iff the atom is in a ring of size k (k in
+    3..7), used for the ring size comparison in
+    transmuting_ring_sizes_rule
+    """
+    inring = np.zeros(mol.GetNumAtoms(), dtype=bool)
+    ringmask = np.zeros(mol.GetNumAtoms(), dtype=np.uint8)
+    for ring in mol.GetRingInfo().AtomRings():
+        idx = list(ring)
+        inring[idx] = True
+        if 3 <= len(ring) <= 7:
+            ringmask[idx] |= np.uint8(1 << (len(ring) - 3))
+    return inring, ringmask
+
+
+# SMARTS patterns used by the scoring rules, compiled once at import
+# time rather than on every rule call
+_SMARTS_SULFONAMIDE = Chem.MolFromSmarts('S(=O)(=O)N')
+# Only picking up N/C containing heterocycles - odd cases like pyran
+# derivatives are not caught. Note that growing pyrrole, furan or
+# thiophene is allowed, hence the [n] in the 5-membered patterns
+_HET_PATTERNS = (Chem.MolFromSmarts('[n]1[c,n][c,n][c,n][c,n][c,n]1'),
+                 Chem.MolFromSmarts('[o,n,s]1[n][c,n][c,n][c,n]1'),
+                 Chem.MolFromSmarts('[o,n,s]1[c,n][n][c,n][c,n]1'))
+
+
+# Element-to-element transform difficulty data for atomic_number_rule.
+# A value of 0.5 is the same behaviour as before, a value of 1 means that the
+# atoms are perfectly equivalent, a value of 0 means that the atoms are perfectly
+# non-equivalent (i.e the penalty should basically remove this atom pair from the
+# MCS). The default for pairs not in this data structure is 0.5.
+#
+# Note that we don't need the symmetry equivalent values: the dense
+# table built below is symmetrized
+_TRANSFORM_DIFFICULTY = {
+  # H to element - not sure this has any effect currently
+  1: { 9: 0.5, 17: 0.25, 35: 0, 53: -0.5 },
+  # O to element - methoxy to Cl/Br is easier than expected
+  8: { 17: 0.85, 35: 0.85 },
+  # F to element
+  9: { 17: 0.5, 35: 0.25, 53: 0 },
+  # Cl to element
+  17: { 35: 0.85, 53: 0.65 },
+  # Br to element
+  35: { 53: 0.85 },
+}
+
+
+def _build_difficulty_table():
+    """
+    Build the dense form of _TRANSFORM_DIFFICULTY as a (119, 119) array
+    indexed by atomic number, so atomic_number_rule can gather all
+    mapped atom pairs in one NumPy operation
+    """
+    table = np.full((119, 119), 0.5)
+    for zi, inner in _TRANSFORM_DIFFICULTY.items():
+        for zj, value in inner.items():
+            table[zi, zj] = value
+            table[zj, zi] = value
+    np.fill_diagonal(table, 1.0)
+    return table
+
+
+_DIFFICULTY_TABLE = _build_difficulty_table()
+
+
+# Cache of the prepared (sanitized, hydrogen-stripped) form of each input
+# molecule, keyed weakly on the molecule itself so entries disappear when
+# the caller releases the molecule. In a typical LOMAP run every molecule
+# takes part in O(N) pairwise MCS calculations, and without this cache the
+# same sanitization and RemoveHs work would be repeated for each pair.
+_prepared_mol_cache = weakref.WeakKeyDictionary()
+
+
+# Atom indices on each full input molecule that currently carry a
+# 'to_mcs' property, keyed weakly on the molecule. Successive mappings
+# (including by a different MCS instance sharing the molecule) clear
+# only these atoms rather than scanning the whole molecule.
+_mapped_prop_atoms = weakref.WeakKeyDictionary()
+
+
+def _prepare_mol(mol, threed):
+    """
+    Sanitize mol (in place), strip its hydrogens, and return a tuple
+    (mol_noh, positions, atomic_numbers) where positions and
+    atomic_numbers are NumPy arrays over the heavy atoms. Results are
+    memoized per input molecule (and per threed flag, as that changes
+    the chiral tags assigned during sanitization).
+    """
+    per_mol = _prepared_mol_cache.setdefault(mol, {})
+
+    if threed not in per_mol:
+        Chem.SanitizeMol(mol)
+
+        # Set chirality flags from 3D coords if working in 3D
+        if threed:
+            Chem.rdmolops.AssignAtomChiralTagsFromStructure(mol, replaceExistingTags=True)
+
+        try:
+            mol_noh = AllChem.RemoveHs(mol)
+        except Exception:
+            mol_noh = AllChem.RemoveHs(mol, sanitize=False)
+            Chem.SanitizeMol(mol_noh, sanitizeOps=Chem.SanitizeFlags.SANITIZE_SETAROMATICITY)
+
+        pos = mol_noh.GetConformer().GetPositions()
+        z = np.array([a.GetAtomicNum() for a in mol_noh.GetAtoms()],
+                     dtype=np.int32)
+        per_mol[threed] = (mol_noh, pos, z)
+
+    return per_mol[threed]
+
+
+def _build_many_worker(task):
+    """
+    Worker for MCS.build_many. Takes a (moli_block, molj_block, options)
+    tuple, rebuilds the molecules from their MolBlock strings and returns
+    a dict with the rule scores and atom match lists for the pair, or a
+    dict with an 'error' entry if the MCS could not be computed.
+    """
+    moli_block, molj_block, options = task
+
+    moli = Chem.MolFromMolBlock(moli_block, sanitize=False, removeHs=False)
+    molj = Chem.MolFromMolBlock(molj_block, sanitize=False, removeHs=False)
+
+    try:
+        mc = MCS(moli, molj, **options)
+        return {
+            'mcsr': mc.mcsr(),
+            'mncar': mc.mncar(),
+            'atomic_number_rule': mc.atomic_number_rule(),
+            'hybridization_rule': mc.hybridization_rule(),
+            'sulfonamides_rule': mc.sulfonamides_rule(),
+            'heterocycles_rule': mc.heterocycles_rule(),
+            'transmuting_methyl_into_ring_rule': mc.transmuting_methyl_into_ring_rule(),
+            'transmuting_ring_sizes_rule': mc.transmuting_ring_sizes_rule(),
+            'heavy_atom_match_list': mc.heavy_atom_match_list(),
+            'all_atom_match_list': mc.all_atom_match_list(),
+        }
+    except Exception as e:
+        return {'error': str(e)}
+
+
 class MCS(object):
     """
 
@@ -71,7 +295,12 @@ class MCS(object):
 
     """
 
-    def __init__(self, moli, molj, time=20, verbose='info', max3d=1000, threed=False):
+    # Class-level memo used by get_or_build, keyed on the canonical SMILES
+    # of both molecules plus the constructor options
+    _cache = {}
+
+    def __init__(self, moli, molj, time=20, verbose='info', max3d=1000, threed=False,
+                 use_gpu=False, seed_mcs=False):
         """
         Initialization function
 
@@ -90,27 +319,50 @@ class MCS(object):
             ???, default 1,000
         threed : bool, optional
             ???, default False
+        use_gpu : bool, optional
+            offload the MCS search to nvMolKit when it is installed,
+            falling back to the CPU implementation otherwise, default False
+        seed_mcs : bool, optional
+            seed the MCS search with the MCS of the two Murcko scaffolds.
+            For congeneric series sharing a scaffold this prunes the
+            search tree dramatically, but the seed constrains the search
+            so the MCS found may differ from the unseeded one, default False
         """
         self.options = {
             'time': time,
             'verbose': verbose,
             'max3d': max3d,
             'threed': threed,
+            'use_gpu': use_gpu,
+            'seed_mcs': seed_mcs,
         }
 
-        def substructure_centre(mol, mol_sub):
+        def substructure_centre(pos, mol_sub):
+            """
+
+            This function takes an (N,3) array of atom coordinates and a
+            list of atom indices into it, and returns the geometric centre
+            of the atoms in the list as a length-3 array
+
             """
 
-            This function takes a molecule and a list of atom indices
-            in that molecule and returns an RDKit Point3D representing
-            the geometric centre of the atoms in the list
+            return pos[list(mol_sub)].mean(axis=0)
 
+
+        def remove_atoms(mol, indices):
             """
 
-            sum = Point3D()
-            for i in mol_sub:
-                sum += mol.GetConformer().GetAtomPosition(i)
-            return sum / len(mol_sub)
+            Return a copy of mol with the given atoms removed. A single
+            EditableMol is constructed for the whole batch, and the
+            indices are deleted highest-first so they stay valid while
+            editing
+
+            """
+
+            edit_mol = Chem.EditableMol(mol)
+            for i in sorted(indices, reverse=True):
+                edit_mol.RemoveAtom(i)
+            return edit_mol.GetMol()
 
 
         def best_substruct_match_to_mcs(moli,molj,by_rmsd=True):
@@ -134,29 +386,56 @@ class MCS(object):
 
             moli_sub = moli.GetSubstructMatches(self.mcs_mol,uniquify=False)
             molj_sub = molj.GetSubstructMatches(self.mcs_mol,uniquify=False)
+
+            # Fast path: an asymmetric MCS gives a single match on each
+            # side, so there is nothing to choose between
+            if len(moli_sub) == 1 and len(molj_sub) == 1:
+                return (np.asarray(moli_sub[0], dtype=np.int32),
+                        np.asarray(molj_sub[0], dtype=np.int32))
+
+            # Pull the candidate matches into index arrays so the scoring
+            # below is done with whole-array NumPy operations rather than
+            # per-atom RDKit calls for every candidate pair
+            mapi_arr = np.array(moli_sub, dtype=np.int32)
+            mapj_arr = np.array(molj_sub, dtype=np.int32)
+
             best_rmsd=1e8
-            for mapi in moli_sub:
-                for mapj in molj_sub:
-                    # Compute the translation to bring molj's centre over moli
-                    coord_delta = 0
-                    if by_rmsd:
-                        coord_delta = (substructure_centre(moli,mapi)
-                                 - substructure_centre(molj,mapj))
-                    rmsd=0
-                    for pair in zip(mapi,mapj):
-                        if by_rmsd:
-                            rmsd += (moli.GetConformer().GetAtomPosition(pair[0])
-                                   - molj.GetConformer().GetAtomPosition(pair[1])
-                                   - coord_delta).LengthSq()
-                        elif (moli.GetAtomWithIdx(pair[0]).GetAtomicNum() !=
-                              molj.GetAtomWithIdx(pair[1]).GetAtomicNum()):
-                            rmsd+=1
-                    if rmsd < best_rmsd:
-                        besti=mapi
-                        bestj=mapj
-                        best_rmsd=rmsd
-
-            return (besti,bestj)
+            besti=0
+            bestj=0
+            if by_rmsd:
+                # Coordinates of each candidate match, centred on the
+                # geometric centre of the matched atoms. Subtracting the
+                # centres up front is equivalent to applying coord_delta
+                # to each pair of matches
+                coords_i = self._pos_i[mapi_arr]
+                coords_j = self._pos_j[mapj_arr]
+                coords_i -= coords_i.mean(axis=1, keepdims=True)
+                coords_j -= coords_j.mean(axis=1, keepdims=True)
+
+                # Highly symmetric molecules can produce dozens of
+                # candidate matches per side; hand those to the compiled
+                # kernel when Numba is around
+                if _best_pair_rmsd is not None and \
+                        len(moli_sub) * len(molj_sub) > 16:
+                    besti, bestj = _best_pair_rmsd(coords_i, coords_j)
+                else:
+                    for i in range(len(moli_sub)):
+                        diff = coords_i[i] - coords_j
+                        rmsd = np.einsum('jkd,jkd->j', diff, diff)
+                        j = int(rmsd.argmin())
+                        if rmsd[j] < best_rmsd:
+                            besti=i
+                            bestj=j
+                            best_rmsd=rmsd[j]
+            else:
+                # Count the number of atomic number mismatches for all
+                # candidate pairs in one go
+                nmismatch = (self._z_i[mapi_arr][:, None, :]
+                             != self._z_j[mapj_arr][None, :, :]).sum(axis=2)
+                besti, bestj = np.unravel_index(int(nmismatch.argmin()),
+                                                nmismatch.shape)
+
+            return (mapi_arr[besti], mapj_arr[bestj])
 
         def trim_mcs_mol(max_deviation=2.0):
             """
@@ -176,28 +455,28 @@ class MCS(object):
 
             while True:
                 (mapi,mapj) = best_substruct_match_to_mcs(self._moli_noh, self._molj_noh, by_rmsd=True)
-                # Compute the translation to bring molj's centre over moli
-                coord_delta = (substructure_centre(self._moli_noh, mapi)
-                               - substructure_centre(self._molj_noh, mapj))
-                worstatomidx=-1
-                worstdist=0
-                atomidx=0
-                for pair in zip(mapi,mapj):
-                    dist = (self._moli_noh.GetConformer().GetAtomPosition(pair[0])
-                          - self._molj_noh.GetConformer().GetAtomPosition(pair[1])
-                          - coord_delta).Length()
-                    if dist > worstdist:
-                        worstdist=dist
-                        worstatomidx=atomidx
-                    atomidx=atomidx+1
-
-                if worstdist > max_deviation:
+
+                pos_i = self._pos_i[mapi]
+                pos_j = self._pos_j[mapj]
+
+                # Compute the translation to bring molj's centre over
+                # moli, and all the mapped-atom deviations, in whole-array
+                # operations. Note that we still only remove one atom per
+                # rematch: the removal changes both the centring and
+                # (for symmetric molecules) possibly the best match, so
+                # removing several atoms at once would trim differently.
+                coord_delta = pos_i.mean(axis=0) - pos_j.mean(axis=0)
+                # Work with squared distances so the common no-op pass
+                # doesn't pay for any square roots
+                d = pos_i - pos_j - coord_delta
+                dists2 = np.einsum('ij,ij->i', d, d)
+                worstatomidx = int(dists2.argmax())
+
+                if dists2[worstatomidx] > max_deviation * max_deviation:
                     # Remove the furthest-away atom and try again
-                    rwm = Chem.RWMol(self.mcs_mol)
-                    rwm.RemoveAtom(worstatomidx)
                     if verbose == 'pedantic':
-                       logging.info('Removing atom %d from MCS based on distance %f' %(worstatomidx,worstdist))
-                    self.mcs_mol=Chem.Mol(rwm)
+                       logging.info('Removing atom %d from MCS based on distance %f', worstatomidx, math.sqrt(dists2[worstatomidx]))
+                    self.mcs_mol = remove_atoms(self.mcs_mol, [worstatomidx])
                 else:
                     break
 
@@ -215,32 +494,29 @@ class MCS(object):
 
             """
 
-            to_remove = []
+            # Flag conflicting MCS atoms in a boolean mask and convert to
+            # indices once at the end; this also deduplicates an atom
+            # flagged through more than one broken bond
+            conflict = np.zeros(self.mcs_mol.GetNumAtoms(), dtype=bool)
             for ai in self.moli.GetAtoms():
-                if ai.HasProp('to_mcs'):    # is ai in the MCS?
-                    aimcs = int(ai.GetProp('to_mcs'))
+                aimcs = self._moli_to_mcs.get(ai.GetIdx())
+                if aimcs is not None:    # is ai in the MCS?
                     for bai in ai.GetNeighbors():
-                        if bai.HasProp('to_mcs'):  # Atom bonded to ai is also in the MCS
-                            baimcs = int(bai.GetProp('to_mcs'))
+                        baimcs = self._moli_to_mcs.get(bai.GetIdx())
+                        if baimcs is not None:  # Atom bonded to ai is also in the MCS
                             if (aimcs<baimcs):  # only do each bond once!
                                 # Check if the corresponding MCS atoms are bonded
                                 if not self.mcs_mol.GetBondBetweenAtoms(aimcs,baimcs):
-                                    to_remove.append(aimcs)
+                                    conflict[aimcs] = True
                                     if verbose == 'pedantic':
-                                       logging.info('Bond in first mol between atoms %d and %d not matched in MCS' %(ai.GetIdx(),bai.GetIdx()))
+                                       logging.info('Bond in first mol between atoms %d and %d not matched in MCS', ai.GetIdx(), bai.GetIdx())
 
+            to_remove = np.nonzero(conflict)[0].tolist()
             if to_remove:
-                # Delete atoms from the MCS, highest index first
-                to_remove.sort(reverse=True)
-
                 if verbose == 'pedantic':
-                   logging.info('Removing %d atoms from MCS based on detection of broken RDKit ring bond matching' %(len(to_remove)))
-
-                edit_mcs_mol = Chem.EditableMol(self.mcs_mol)
-                for i in to_remove:
-                    edit_mcs_mol.RemoveAtom(i)
+                   logging.info('Removing %d atoms from MCS based on detection of broken RDKit ring bond matching', len(to_remove))
 
-                self.mcs_mol = edit_mcs_mol.GetMol()
+                self.mcs_mol = remove_atoms(self.mcs_mol, to_remove)
                 map_mcs_mol()   # Regenerate mappings
 
         def trim_mcs_chiral_atoms():
@@ -265,18 +541,14 @@ class MCS(object):
 
                 return parity
 
-            def atom_mcs_chiral_parity(a):
+            def atom_mcs_chiral_parity(a, to_mcs):
                 """
                     Take the neighbours of chiral atom a. Get the index of each of these atoms
-                    in the MCS. Combine the parity of this list with the chirality flag for
-                    a to determine the "MCS parity".
+                    in the MCS (via the provided index dict). Combine the parity of this list
+                    with the chirality flag for a to determine the "MCS parity".
                 """
-                nbrs=[]
-                for aj in a.GetNeighbors():
-                    try:
-                        nbrs.append(int(aj.GetProp('to_mcs')))
-                    except Exception:
-                        nbrs.append(1000)   # should not be more than one!
+                nbrs=[to_mcs.get(aj.GetIdx(), 1000)   # should not be more than one!
+                      for aj in a.GetNeighbors()]
 
                 if not permutation_parity(nbrs):
                     if a.GetChiralTag()==Chem.rdchem.ChiralType.CHI_TETRAHEDRAL_CW: return Chem.rdchem.ChiralType.CHI_TETRAHEDRAL_CCW
@@ -301,31 +573,28 @@ class MCS(object):
 
                 for i in chiral_at_moli:
                     # Is atom i in the MCS?
-                    ai = moli.GetAtomWithIdx(i)
-                    if (ai.HasProp('to_mcs')):
+                    mcs_i = self._moli_to_mcs.get(i)
+                    if mcs_i is not None:
                         for j in chiral_at_molj:
-                            # Is atom j in the MCS?
-                            aj = molj.GetAtomWithIdx(j)
-                            if (aj.HasProp('to_mcs')):
-                                # Are they the same atom?
-                                if (ai.GetProp('to_mcs') == aj.GetProp('to_mcs')):
-                                    # OK, atoms are both chiral, and match the same MCS atom.
-                                    # Take the list of neighbours for ai, and get their indices in
-                                    # the MCS. Use the parity of this index list together with the
-                                    # chiral parity of ai to work out the "MCS parity". Do the same
-                                    # for aj and check if the two are the same.
-                                    #
-                                    # If not, flag with the CHI_TETRAHEDRAL_CW property.
-                                    pi = atom_mcs_chiral_parity(ai)
-                                    pj = atom_mcs_chiral_parity(aj)
-                                    if (pi!=pj):
-                                        invertedatoms.append(int(aj.GetProp('to_mcs')))
+                            # Is atom j in the MCS, and is it the same atom?
+                            if self._molj_to_mcs.get(j) == mcs_i:
+                                # OK, atoms are both chiral, and match the same MCS atom.
+                                # Take the list of neighbours for ai, and get their indices in
+                                # the MCS. Use the parity of this index list together with the
+                                # chiral parity of ai to work out the "MCS parity". Do the same
+                                # for aj and check if the two are the same.
+                                #
+                                # If not, flag with the CHI_TETRAHEDRAL_CW property.
+                                pi = atom_mcs_chiral_parity(moli.GetAtomWithIdx(i), self._moli_to_mcs)
+                                pj = atom_mcs_chiral_parity(molj.GetAtomWithIdx(j), self._molj_to_mcs)
+                                if (pi!=pj):
+                                    invertedatoms.append(mcs_i)
 
                 for i in invertedatoms:
                     mcsat = self.mcs_mol.GetAtomWithIdx(i)
                     mcsat.SetChiralTag(Chem.rdchem.ChiralType.CHI_TETRAHEDRAL_CW)
                     if verbose == 'pedantic':
-                       logging.info('Inverted chiral atom detected: %d' %(i))
+                       logging.info('Inverted chiral atom detected: %d', i)
 
 
             # Flag inverted atoms
@@ -335,62 +604,51 @@ class MCS(object):
             # fragment the molecule, and keep only the two largest fragments. Rinse and
             # repeat until no more flagged chiral centres remain.
 
-            while True:
-                mcs_chiral_set = set()
-                atom_idx = -1;
-
-                for atom in self.mcs_mol.GetAtoms():
-                    # Note that any atom in the MCS which has inverted chirality between the input mols is
-                    # flagged with CHI_TETRAHEDRAL_CW
-                    if (atom.GetChiralTag() == Chem.rdchem.ChiralType.CHI_TETRAHEDRAL_CW):
-                        atom_idx=atom.GetIdx()
-                        atom.SetChiralTag(Chem.rdchem.ChiralType.CHI_UNSPECIFIED)  # Remove from consideration for the next loop
-                        break
-
-                if atom_idx == -1:  # Not found any more chiral atoms, so done
-                    break
+            # Collect the flagged atoms in a single scan, rather than re-scanning
+            # the whole molecule after each deletion. The flagged indices are kept
+            # current by translating them through every renumbering and removal
+            # below; a flagged atom that is itself deleted as part of another
+            # atom's fragment simply drops out of the list.
+            flagged = []
+            for atom in self.mcs_mol.GetAtoms():
+                # Note that any atom in the MCS which has inverted chirality between the input mols is
+                # flagged with CHI_TETRAHEDRAL_CW
+                if (atom.GetChiralTag() == Chem.rdchem.ChiralType.CHI_TETRAHEDRAL_CW):
+                    atom.SetChiralTag(Chem.rdchem.ChiralType.CHI_UNSPECIFIED)
+                    flagged.append(atom.GetIdx())
+
+            while flagged:
+                atom_idx = flagged.pop(0)
 
                 # Move the chiral atom to the end (avoids indexing problems)
                 newindexes = list(range(self.mcs_mol.GetNumAtoms()))
                 newindexes.remove(atom_idx)
                 newindexes.append(atom_idx)
                 self.mcs_mol = Chem.RenumberAtoms(self.mcs_mol,newindexes)
+                flagged = [f - 1 if f > atom_idx else f for f in flagged]
 
                 # Now we loop, deleting groups attached to the chiral atom, until the
                 # chiral atom has at most two heavy atom connections
-                # Note that getAtoms()[-1] returns the first atom not the last if you
-                # don't convert it to a list. Grr.
-                while list(self.mcs_mol.GetAtoms())[-1].GetDegree() > 2 :
+                natoms = self.mcs_mol.GetNumAtoms()
+                while self.mcs_mol.GetAtomWithIdx(natoms-1).GetDegree() > 2 :
 
                     # Delete the chiral atom in a temporary molecule, and fragment. Since the
                     # chiral atom was the last one, the indexes in the temporary molecule are the
                     # same as in self.mcs_mol
                     edit_mol = Chem.EditableMol(self.mcs_mol)
-                    edit_mol.RemoveAtom(self.mcs_mol.GetNumAtoms()-1)
-                    tmp_mol = edit_mol.GetMol()
-                    fragments = Chem.rdmolops.GetMolFrags(tmp_mol)
-
-                    # Get index of smallest fragments
-                    min_idx = 0
-                    lgt_min = 10000
+                    edit_mol.RemoveAtom(natoms-1)
+                    fragments = Chem.rdmolops.GetMolFrags(edit_mol.GetMol())
 
-                    for idx in range(0, len(fragments)):
-                        lgt = len(fragments[idx])
-                        if lgt < lgt_min:
-                            lgt_min = lgt
-                            min_idx = idx
-
-                    # Get the atoms in this fragment and sort them so we delete the
-                    # largest index first
-                    min_frag = list(fragments[min_idx])
-                    min_frag.sort(reverse=True)
+                    # Get the atoms in the smallest fragment
+                    min_frag = min(fragments, key=len)
 
                     if verbose == 'pedantic':
-                       logging.info('Removing %d atoms to remove chiral inversion' %(len(min_frag)))
-                    edit_mol = Chem.EditableMol(self.mcs_mol)
-                    for idx in min_frag:
-                        edit_mol.RemoveAtom(idx)
-                    self.mcs_mol = edit_mol.GetMol()
+                       logging.info('Removing %d atoms to remove chiral inversion', len(min_frag))
+                    self.mcs_mol = remove_atoms(self.mcs_mol, min_frag)
+                    natoms -= len(min_frag)
+                    removed = set(min_frag)
+                    flagged = [f - sum(1 for r in removed if r < f)
+                               for f in flagged if f not in removed]
 
             map_mcs_mol()   # Regenerate mappings after deletion
             # Done!
@@ -404,30 +662,36 @@ class MCS(object):
                 example.
             """
 
-            to_remove = []
-            for at in self.mcs_mol.GetAtoms():
-                moli_idx = int(at.GetProp('to_moli'))
-                moli_at = self._moli_noh.GetAtomWithIdx(moli_idx)
-                molj_idx = int(at.GetProp('to_molj'))
-                molj_at = self._moli_noh.GetAtomWithIdx(moli_idx)
-
-                # Testing moli and molj is redundant due to the way that the
-                # MCS is calculated, but I'd rather be paranoid here
-                if (moli_at.IsInRing() and molj_at.IsInRing() and not at.IsInRing()):
-                    to_remove.append(at.GetIdx())
+            # One pass over the ring lists for the sanitized parent
+            # molecules; the MCS has to use the per-atom flags, as its
+            # ring lists are dropped when the trims rebuild it through
+            # EditableMol while the atom flags survive
+            def parent_inring(mol):
+                mask = np.zeros(mol.GetNumAtoms(), dtype=bool)
+                for ring in mol.GetRingInfo().AtomRings():
+                    mask[list(ring)] = True
+                return mask
+
+            moli_inring = parent_inring(self._moli_noh)
+            molj_inring = parent_inring(self._molj_noh)
+            mcs_inring = np.array(
+                    [a.IsInRing() for a in self.mcs_mol.GetAtoms()],
+                    dtype=bool)
+
+            # The mapping rows are in MCS atom order, so the conflict
+            # mask indexes the MCS directly. Testing moli and molj is
+            # redundant due to the way that the MCS is calculated, but
+            # I'd rather be paranoid here
+            conflict = (moli_inring[self._map_moli_molj[:, 0]]
+                        & molj_inring[self._map_moli_molj[:, 1]]
+                        & ~mcs_inring)
+            to_remove = np.nonzero(conflict)[0].tolist()
 
             if to_remove:
-                # Delete atoms from the MCS, highest index first
-                to_remove.sort(reverse=True)
-
                 if verbose == 'pedantic':
-                    logging.info('Removing %d atoms from MCS to clear up partial rings' %(len(to_remove)))
-
-                edit_mcs_mol = Chem.EditableMol(self.mcs_mol)
-                for i in to_remove:
-                    edit_mcs_mol.RemoveAtom(i)
+                    logging.info('Removing %d atoms from MCS to clear up partial rings', len(to_remove))
 
-                self.mcs_mol = edit_mcs_mol.GetMol()
+                self.mcs_mol = remove_atoms(self.mcs_mol, to_remove)
 
                 map_mcs_mol()   # Regenerate mappings after deletion
 
@@ -448,7 +712,8 @@ class MCS(object):
             # mcs to moli
             map_mcs_mol_to_moli_sub = list(zip(mcsi_sub, moli_sub))
 
-            # Clear all properties as we may call this function more than once
+            # Clear stale properties as we may call this function more than
+            # once, and the input molecules may be shared between MCS objects.
             # Here are all the properties we use:
             # `to_moli` and `to_molj`: this gives the atom correspondence
             # between the mcs molecule and the heavy atom only moli and molj
@@ -458,15 +723,27 @@ class MCS(object):
             # removal of hydrogens) molecules.
             # `to_mcs` this gives the correspondence between the full
             # (including hydrogens) molecule and the mcs molecule
-            for a in self.mcs_mol.GetAtoms():
-                a.ClearProp('to_moli')
-                a.ClearProp('to_moli_all')
-                a.ClearProp('to_molj')
-                a.ClearProp('to_molj_all')
-            for a in self.moli.GetAtoms():
-                a.ClearProp('to_mcs')
-            for a in self.molj.GetAtoms():
-                a.ClearProp('to_mcs')
+            #
+            # Only the atoms recorded as written by the previous mapping
+            # need clearing; the mcs molecule needs no pass of its own
+            # because every one of its atoms is rewritten below. A
+            # molecule we have never mapped on gets one full sweep, since
+            # Chem.Mol copies inherit atom properties from their source
+            for mol in (self.moli, self.molj):
+                prev = _mapped_prop_atoms.get(mol)
+                if prev is None:
+                    for a in mol.GetAtoms():
+                        a.ClearProp('to_mcs')
+                else:
+                    for i in prev:
+                        mol.GetAtomWithIdx(i).ClearProp('to_mcs')
+
+            # The to_mcs mapping is also mirrored in plain dicts (keyed by
+            # the atom index in the full molecule), so that the chiral
+            # checking code can look atoms up without going through the
+            # RDKit property store
+            self._moli_to_mcs = {}
+            self._molj_to_mcs = {}
 
             # An RDkit atomic property is defined to store the mapping to moli
             for idx in map_mcs_mol_to_moli_sub:
@@ -476,14 +753,17 @@ class MCS(object):
                         'to_moli_all', str(self._map_moli_noh[idx[1]]))
                 self.moli.GetAtomWithIdx(self._map_moli_noh[idx[1]]).SetProp(
                         'to_mcs', str(idx[0]))
+                self._moli_to_mcs[self._map_moli_noh[idx[1]]] = idx[0]
 
             mcsj_sub = tuple(range(self.mcs_mol.GetNumAtoms()))
 
             # mcs to molj
             map_mcs_mol_to_molj_sub = list(zip(mcsj_sub, molj_sub))
 
-            # Map between the two molecules
-            self._map_moli_molj = list(zip(moli_sub, molj_sub))
+            # Map between the two molecules, kept as a (k, 2) int32 array
+            # so that consumers can index coordinate arrays with it
+            # directly; get_map() converts to tuples at the API boundary
+            self._map_moli_molj = np.stack((moli_sub, molj_sub), axis=1)
 
             # An RDkit atomic property is defined to store the mapping to molj
             for idx in map_mcs_mol_to_molj_sub:
@@ -493,6 +773,12 @@ class MCS(object):
                         'to_molj_all', str(self._map_molj_noh[idx[1]]))
                 self.molj.GetAtomWithIdx(self._map_molj_noh[idx[1]]).SetProp(
                         'to_mcs', str(idx[0]))
+                self._molj_to_mcs[self._map_molj_noh[idx[1]]] = idx[0]
+
+            # Record which atoms now carry 'to_mcs' so the next mapping
+            # only has to clear those
+            _mapped_prop_atoms[self.moli] = tuple(self._moli_to_mcs)
+            _mapped_prop_atoms[self.molj] = tuple(self._molj_to_mcs)
 
             # For each mcs atom we save its original index in a specified
             # property. This could be very useful in the code development
@@ -516,24 +802,17 @@ class MCS(object):
                 the molecule used to define the atom ring counters
             """
 
-            # set to zero the atom ring counters
-            for at in mol.GetAtoms():
-                at.SetProp('rc', '0')
-
-            rginfo = mol.GetRingInfo()
-
-            rgs = rginfo.AtomRings()
+            # Count ring membership with one pass over the ring lists.
+            # Note that RingInfo.NumAtomRings would be simpler still, but
+            # it requires fully-initialised ring info which the
+            # SMARTS-derived MCS molecule does not have
+            counts = [0] * mol.GetNumAtoms()
+            for ring in mol.GetRingInfo().AtomRings():
+                for idx in ring:
+                    counts[idx] += 1
 
-            # print rgs
-
-            rgs_set = set([e for l in rgs for e in l])
-
-            for idx in rgs_set:
-                for r in rgs:
-                    if idx in r:
-                        val = int(mol.GetAtomWithIdx(idx).GetProp('rc'))
-                        val = val + 1
-                        mol.GetAtomWithIdx(idx).SetProp('rc', str(val))
+            for at in mol.GetAtoms():
+                at.SetProp('rc', str(counts[at.GetIdx()]))
             return
 
         # START of __init__ function
@@ -543,51 +822,86 @@ class MCS(object):
         # Global beta setting for atom penalties
         self.beta = 0.1
 
+        # Lazy cache of the MCS-stripped molecules used by the
+        # sulfonamide and heterocycle rules, see _strip_mcs
+        self._stripped_mols = {}
+
         # Local pointers to the passed molecules
         self.moli = moli
         self.molj = molj
 
-        # Sanitize input molecules
-        Chem.SanitizeMol(self.moli)
-        Chem.SanitizeMol(self.molj)
-
-        # Set chirality flags from 3D coords if working in 3D
-        if threed:
-            Chem.rdmolops.AssignAtomChiralTagsFromStructure(self.moli,replaceExistingTags=True)
-            Chem.rdmolops.AssignAtomChiralTagsFromStructure(self.molj,replaceExistingTags=True)
-
         if not verbose == 'pedantic':
             lg = RDLogger.logger()
             lg.setLevel(RDLogger.CRITICAL)
 
-        # Local pointers to the passed molecules without hydrogens
-        # These variables are defined as private
-        try:
-            self._moli_noh = AllChem.RemoveHs(moli)
-            self._molj_noh = AllChem.RemoveHs(molj)
-        except Exception:
-            self._moli_noh = AllChem.RemoveHs(moli, sanitize=False)
-            self._molj_noh = AllChem.RemoveHs(molj, sanitize=False)
-
-            Chem.SanitizeMol(self._moli_noh, sanitizeOps=Chem.SanitizeFlags.SANITIZE_SETAROMATICITY)
-            Chem.SanitizeMol(self._molj_noh, sanitizeOps=Chem.SanitizeFlags.SANITIZE_SETAROMATICITY)
+        # Sanitize the input molecules and strip their hydrogens, also
+        # caching the heavy-atom coordinates and atomic numbers as NumPy
+        # arrays. This work is memoized per molecule, as each molecule
+        # typically takes part in many pairwise MCS calculations.
+        # The no-hydrogen variables are defined as private
+        self._moli_noh, self._pos_i, self._z_i = _prepare_mol(self.moli, threed)
+        self._molj_noh, self._pos_j, self._z_j = _prepare_mol(self.molj, threed)
 
         # Get maps of the atom correspondences between the no hydrogen
         # molecules and the original molecules
         self._map_moli_noh = self._heavy_to_all_pos_remap(self._moli_noh, moli)
         self._map_molj_noh = self._heavy_to_all_pos_remap(self._molj_noh, molj)
 
+        # Optionally seed the MCS search with the (small, fast) MCS of the
+        # two Murcko scaffolds. A good seed gives the branch-and-bound
+        # search a tight lower bound to prune with
+        seed_smarts = ''
+        if seed_mcs:
+            try:
+                scaf_i = MurckoScaffold.GetScaffoldForMol(self._moli_noh)
+                scaf_j = MurckoScaffold.GetScaffoldForMol(self._molj_noh)
+                if scaf_i.GetNumAtoms() and scaf_j.GetNumAtoms():
+                    __scaf_mcs = rdFMCS.FindMCS([scaf_i, scaf_j],
+                                                timeout=time,
+                                                atomCompare=rdFMCS.AtomCompare.CompareAny,
+                                                bondCompare=rdFMCS.BondCompare.CompareAny,
+                                                matchValences=False,
+                                                ringMatchesRingOnly=True,
+                                                completeRingsOnly=True,
+                                                matchChiralTag=False)
+                    if not __scaf_mcs.canceled and __scaf_mcs.numAtoms > 0:
+                        seed_smarts = __scaf_mcs.smartsString
+            except Exception:
+                # Fall back to an unseeded search on any scaffold trouble
+                seed_smarts = ''
+
         # MCS calculation. In RDKit the MCS is a smart string. Ring atoms are
         # always mapped in ring atoms.
         # Don't add the mcs result as a member variable as it can't be pickled
-        __mcs = rdFMCS.FindMCS([self._moli_noh, self._molj_noh],
-                               timeout=time,
-                               atomCompare=rdFMCS.AtomCompare.CompareAny,
-                               bondCompare=rdFMCS.BondCompare.CompareAny,
-                               matchValences=False,
-                               ringMatchesRingOnly=True,
-                               completeRingsOnly=True,
-                               matchChiralTag=False)
+        __mcs = None
+
+        # Optionally offload the search to the GPU. Small pairs don't
+        # amortize the transfer overhead, so they stay on the CPU
+        if use_gpu and _nvmcs is not None and \
+                min(self._moli_noh.GetNumAtoms(), self._molj_noh.GetNumAtoms()) >= 30:
+            try:
+                __mcs = _nvmcs.FindMCS([self._moli_noh, self._molj_noh],
+                                       timeout=time,
+                                       atomCompare=rdFMCS.AtomCompare.CompareAny,
+                                       bondCompare=rdFMCS.BondCompare.CompareAny,
+                                       matchValences=False,
+                                       ringMatchesRingOnly=True,
+                                       completeRingsOnly=True,
+                                       matchChiralTag=False)
+            except Exception as e:
+                logging.warning('GPU MCS failed (%s), falling back to CPU' % e)
+                __mcs = None
+
+        if __mcs is None:
+            __mcs = rdFMCS.FindMCS([self._moli_noh, self._molj_noh],
+                                   timeout=time,
+                                   atomCompare=rdFMCS.AtomCompare.CompareAny,
+                                   bondCompare=rdFMCS.BondCompare.CompareAny,
+                                   matchValences=False,
+                                   ringMatchesRingOnly=True,
+                                   completeRingsOnly=True,
+                                   matchChiralTag=False,
+                                   seedSmarts=seed_smarts)
 
         # Note that we need matchChiralTag=False as we want to match chiral atoms with different
         # parities, we just need to trim the MCS to the largest possible match that doesn't have
@@ -615,7 +929,7 @@ class MCS(object):
         testmol = Chem.MolFromSmarts("*")   # Create a "match anything" query atom for us to copy
         for a in self.mcs_mol.GetAtoms():
             if a.DescribeQuery().startswith("AtomOr"):  # Matches more than one element
-                a.SetQuery(testmol.GetAtoms()[0])   # Set this atom to a copy of the "match anything" atom
+                a.SetQuery(testmol.GetAtomWithIdx(0))   # Set this atom to a copy of the "match anything" atom
 
         try:  # Try to sanitize the MCS molecule
             Chem.SanitizeMol(self.mcs_mol)
@@ -653,6 +967,88 @@ class MCS(object):
         set_ring_counter(self._molj_noh)
         set_ring_counter(self.mcs_mol)
 
+        # Cache the atom counts used by the scoring rules - neither the
+        # molecules nor the MCS change after construction, and the rules
+        # are called once per pair across the whole score matrix.
+        # Note that the mcs_mol (a) doesn't contain hydrogens, and (b) does
+        # contain wildcard atoms, which don't count as 'heavy', which is why
+        # both MCS counts are kept
+        self._nha_moli = self.moli.GetNumHeavyAtoms()
+        self._nha_molj = self.molj.GetNumHeavyAtoms()
+        self._nha_mcs = self.mcs_mol.GetNumAtoms()
+        self._nha_mcs_heavy = self.mcs_mol.GetNumHeavyAtoms()
+
+        # Pull the per-atom properties the scoring rules consume into
+        # one structure-of-arrays view of the match, so the rules don't
+        # have to re-parse the RDKit string properties on every call.
+        # The mapping arrays are views of the final moli/molj map in MCS
+        # atom order; the atomic numbers of the heavy-atom molecules are
+        # already in self._z_i / self._z_j from _prepare_mol
+        self._match_soa = types.SimpleNamespace(
+                to_moli=self._map_moli_molj[:, 0],
+                to_molj=self._map_moli_molj[:, 1],
+                rc=np.fromiter(
+                        (int(a.GetProp('rc'))
+                         for a in self.mcs_mol.GetAtoms()),
+                        dtype=np.int32, count=self._nha_mcs),
+                aromatic=np.array(
+                        [a.GetIsAromatic() for a in self.mcs_mol.GetAtoms()],
+                        dtype=bool))
+
+        # Short aliases for the heavily-used fields
+        self._to_moli = self._match_soa.to_moli
+        self._to_molj = self._match_soa.to_molj
+        self._mcs_rc = self._match_soa.rc
+
+        # Inverse of to_moli: the MCS atom index for each moli heavy
+        # atom, or -1 for atoms outside the MCS
+        self._mcs_idx_by_to_moli = np.full(self._moli_noh.GetNumAtoms(),
+                                           -1, dtype=np.int32)
+        self._mcs_idx_by_to_moli[self._to_moli] = np.arange(
+                self._nha_mcs, dtype=np.int32)
+        self._moli_noh_rc = np.fromiter(
+                (int(a.GetProp('rc')) for a in self._moli_noh.GetAtoms()),
+                dtype=np.int32, count=self._moli_noh.GetNumAtoms())
+        self._molj_noh_rc = np.fromiter(
+                (int(a.GetProp('rc')) for a in self._molj_noh.GetAtoms()),
+                dtype=np.int32, count=self._molj_noh.GetNumAtoms())
+        self._moli_hyb = np.array(
+                [atom_hybridization(a) for a in self._moli_noh.GetAtoms()],
+                dtype=np.int8)
+        self._molj_hyb = np.array(
+                [atom_hybridization(a) for a in self._molj_noh.GetAtoms()],
+                dtype=np.int8)
+
+        # Adjacency lists and ring membership of the heavy-atom molecules,
+        # used by the transmuting rules to find the bonds that leave the
+        # MCS without rescanning every bond per MCS atom
+        self._moli_neighbors = [
+                np.array([n.GetIdx() for n in a.GetNeighbors()],
+                         dtype=np.int32)
+                for a in self._moli_noh.GetAtoms()]
+        self._molj_neighbors = [
+                np.array([n.GetIdx() for n in a.GetNeighbors()],
+                         dtype=np.int32)
+                for a in self._molj_noh.GetAtoms()]
+        self._moli_inring, self._moli_ringmask = \
+                _ring_membership_arrays(self._moli_noh)
+        self._molj_inring, self._molj_ringmask = \
+                _ring_membership_arrays(self._molj_noh)
+
+        # The first substructure match of the MCS in each heavy-atom
+        # molecule, with boolean membership masks. The transmuting rules
+        # used to redo this VF2 search (and rebuild the masks) per call;
+        # nothing it depends on changes after construction
+        self._moli_sub = self._moli_noh.GetSubstructMatch(self.mcs_mol)
+        self._molj_sub = self._molj_noh.GetSubstructMatch(self.mcs_mol)
+        self._moli_sub_mask = np.zeros(self._moli_noh.GetNumAtoms(),
+                                       dtype=bool)
+        self._moli_sub_mask[list(self._moli_sub)] = True
+        self._molj_sub_mask = np.zeros(self._molj_noh.GetNumAtoms(),
+                                       dtype=bool)
+        self._molj_sub_mask[list(self._molj_sub)] = True
+
+
         # for at in self.mcs_mol.GetAtoms():
         #     print 'at = %d rc = %d' % (at.GetIdx(), int(at.GetProp('rc')))
 
@@ -676,17 +1072,18 @@ class MCS(object):
         tolerance : float
             Maximum deviation acceptable between corresponding atoms.
         """
+        heavy_pos = heavy_mol.GetConformer().GetPositions()
+        all_pos = all_mol.GetConformer().GetPositions()
+
+        # Squared distance between every (heavy, all) atom pair in one
+        # array operation, then pick the closest partner per heavy atom
+        dist2 = ((heavy_pos[:, None, :] - all_pos[None, :, :]) ** 2).sum(axis=2)
+        closest = dist2.argmin(axis=1)
+
         mapping = {}
-        for at in heavy_mol.GetAtoms():
-            best = tolerance
-            at_idx = at.GetIdx()
-            pos = heavy_mol.GetConformer().GetAtomPosition(at_idx)
-            for at2 in all_mol.GetAtoms():
-                at2_idx = at2.GetIdx()
-                pos2 = all_mol.GetConformer().GetAtomPosition(at2_idx)
-                if (pos - pos2).Length() < best:
-                    best = (pos - pos2).Length()
-                    mapping[at_idx] = at2_idx
+        for at_idx, at2_idx in enumerate(closest):
+            if dist2[at_idx, at2_idx] < tolerance * tolerance:
+                mapping[at_idx] = int(at2_idx)
         return mapping
 
     @staticmethod
@@ -805,8 +1202,122 @@ class MCS(object):
         return map_moli_to_molj
 
 
+    @staticmethod
+    def build_many(pairs, time=20, verbose='info', max3d=1000, threed=False,
+                   n_jobs=None):
+
+        """
+        Compute the MCS and rule scores for many molecule pairs in
+        parallel, distributing the pairs over a pool of worker processes.
+        Each MCS construction is CPU-bound and independent of the others,
+        so this scales close to linearly with the core count.
+
+        Parameters
+        ----------
+
+        pairs : list of (RDKit molecule object, RDKit molecule object)
+            the molecule pairs used to perform the MCS calculations
+        time, verbose, max3d, threed :
+            passed through to the MCS constructor, see there
+        n_jobs : int, optional
+            the number of worker processes, default the core count
+
+        Returns:
+        --------
+        results : python list of dict
+            one dict per pair, in the input order, holding the individual
+            rule scores and the heavy/all atom match lists. If the MCS
+            calculation for a pair failed, its dict has a single 'error'
+            entry with the exception message instead.
+
+        """
+
+        options = {'time': time, 'verbose': verbose, 'max3d': max3d,
+                   'threed': threed}
+
+        # The molecules are shipped to the workers as MolBlock strings as
+        # molecule pickling does not preserve the conformers/properties we
+        # rely on
+        tasks = [(Chem.MolToMolBlock(moli, kekulize=False),
+                  Chem.MolToMolBlock(molj, kekulize=False),
+                  options)
+                 for (moli, molj) in pairs]
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            return list(pool.map(_build_many_worker, tasks))
+
+    @classmethod
+    def get_or_build(cls, moli, molj, **options):
+
+        """
+        Memoizing factory: return a cached MCS instance for the passed
+        molecule pair and options, constructing and caching one on the
+        first call. The cache key is the canonical SMILES of both
+        molecules plus the constructor options, so repeated lookups of
+        the same pair (a common pattern when the same ligands appear in
+        many graph edges) skip the expensive MCS search entirely.
+
+        Note that keying on SMILES makes the cache topology-based: two
+        conformers of the same molecule hit the same entry. Callers that
+        need per-conformer results (e.g. threed=True with different
+        embeddings) should construct MCS directly.
+
+        Parameters
+        ----------
+
+        moli : RDKit molecule object
+            the first molecule used to perform the MCS calculation
+        molj : RDKit molecule object
+            the second molecule used to perform the MCS calculation
+        options :
+            passed through to the MCS constructor, see there
+
+        Returns:
+        --------
+        : MCS object
+            the cached or freshly constructed MCS instance
+
+        """
+
+        key = (Chem.MolToSmiles(moli), Chem.MolToSmiles(molj),
+               tuple(sorted(options.items())))
+
+        if key not in cls._cache:
+            cls._cache[key] = cls(moli, molj, **options)
+
+        return cls._cache[key]
+
+    def _strip_mcs(self, mol):
+        """
+        Return the passed heavy-atom molecule with the MCS deleted,
+        memoizing the result on the instance - the sulfonamide and
+        heterocycle rules both need the same stripped molecules
+
+        Parameters
+        ----------
+        mol : RDKit molecule object
+            either self._moli_noh or self._molj_noh
+        """
+        key = id(mol)
+        if key not in self._stripped_mols:
+            if not mol.HasSubstructMatch(self.mcs_mol):
+                raise ValueError('RDkit MCS Subgraph molecule search failed in MCS deletion')
+
+            self._stripped_mols[key] = rdmolops.DeleteSubstructs(mol, self.mcs_mol)
+        return self._stripped_mols[key]
+
     ############ MCS BASED RULES ############
 
+    def mcsr_raw(self):
+        """
+        The raw accumulator behind mcsr: the number of heavy atoms lost
+        going from the two molecules to the MCS. The number of heavy
+        atoms in each molecule is cached at construction time; the MCS
+        uses the total atom count as its wildcard atoms don't count as
+        'heavy'
+        """
+        return self._nha_moli + self._nha_molj - 2 * self._nha_mcs
+
     def mcsr(self):
 
         """
@@ -821,17 +1332,10 @@ class MCS(object):
 
         """
 
-        # The number of heavy atoms in each molecule
-        nha_moli = self.moli.GetNumHeavyAtoms()
-        nha_molj = self.molj.GetNumHeavyAtoms()
-        # Note that the mcs_mol (a) doesn't contain hydrogens, and (b) does contain
-        # wildcard atoms, which don't count as 'heavy'. Use the total atom count instead.
-        nha_mcs_mol = self.mcs_mol.GetNumAtoms()
-
         # score
-        scr_mcsr = math.exp(-self.beta * (nha_moli + nha_molj - 2 * nha_mcs_mol))
+        scr_mcsr = math.exp(-self.beta * self.mcsr_raw())
 
-        logging.info('MCSR from MCS size %d, molecule sizes %d,%d is %f' %(nha_mcs_mol,nha_moli,nha_molj,scr_mcsr))
+        logging.info('MCSR from MCS size %d, molecule sizes %d,%d is %f', self._nha_mcs, self._nha_moli, self._nha_molj, scr_mcsr)
 
         return scr_mcsr
 
@@ -857,9 +1361,9 @@ class MCS(object):
         # This rule has been modified from the rule desribed in the Lomap paper
         # to match the LOMAP first implementation provided by schrodinger
 
-        nha_mcs_mol = self.mcs_mol.GetNumHeavyAtoms()
-        nha_moli = self.moli.GetNumHeavyAtoms()
-        nha_molj = self.molj.GetNumHeavyAtoms()
+        nha_mcs_mol = self._nha_mcs_heavy
+        nha_moli = self._nha_moli
+        nha_molj = self._nha_molj
 
         scr_mncar = float((nha_mcs_mol >= ths) or (nha_moli < ths + 3) or (nha_molj < ths + 3))
 
@@ -872,6 +1376,20 @@ class MCS(object):
     def tmcsr(self, strict_flag=True):
         return 1.0
 
+    def atomic_number_rule_raw(self):
+        """
+        The raw mismatch count behind atomic_number_rule. Gathers the
+        transform difficulty for every mapped atom pair from the dense
+        lookup table, then sums the penalties of the pairs whose
+        elements actually differ
+        """
+        ai = self._z_i[self._to_moli]
+        aj = self._z_j[self._to_molj]
+        if _atomic_number_mismatch is not None:
+            return float(_atomic_number_mismatch(ai, aj, _DIFFICULTY_TABLE))
+        diff = _DIFFICULTY_TABLE[ai, aj]
+        return float((1.0 - diff)[ai != aj].sum())
+
     # AtomicNumber rule
     def atomic_number_rule(self):
 
@@ -886,53 +1404,45 @@ class MCS(object):
 
         """
 
-        # A value of 0.5 is the same behaviour as before, a value of 1 means that the
-        # atoms are perfectly equivalent, a value of 0 means that the atoms are perfectly
-        # non-equivalent (i.e the penalty should basically remove this atom pair from the
-        # MCS). The default for pairs not in this data structure is 0.5.
-        #
-        # Note that we don't need the symmetry equivalent values: we will use the large of
-        # [i][j] and [j][i]
-        transform_difficulty={
-          # H to element - not sure this has any effect currently
-          1: { 9: 0.5, 17: 0.25, 35: 0, 53: -0.5 },
-          # O to element - methoxy to Cl/Br is easier than expected
-          8: { 17: 0.85, 35: 0.85 },
-          # F to element
-          9: { 17: 0.5, 35: 0.25, 53: 0 },
-          # Cl to element
-          17: { 35: 0.85, 53: 0.65 },
-          # Br to element
-          35: { 53: 0.85 },
-        }
-        nmismatch=0
-        for at in self.mcs_mol.GetAtoms():
-            moli_idx = int(at.GetProp('to_moli'))
-            molj_idx = int(at.GetProp('to_molj'))
-            moli_a = self._moli_noh.GetAtoms()[moli_idx]
-            molj_a = self._molj_noh.GetAtoms()[molj_idx]
-
-            if moli_a.GetAtomicNum() != molj_a.GetAtomicNum():
-                ij=-1
-                ji=-1
-                try:
-                    ij=transform_difficulty[moli_a.GetAtomicNum()][molj_a.GetAtomicNum()]
-                except KeyError:
-                    pass
-                try:
-                    ji=transform_difficulty[molj_a.GetAtomicNum()][moli_a.GetAtomicNum()]
-                except KeyError:
-                    pass
-                diff = max(ij,ji)
-                if (diff==-1):
-                    diff=0.5    # default for elements not found
-
-                nmismatch+=(1-diff)
-
+        nmismatch = self.atomic_number_rule_raw()
         an_score =  math.exp(-1 * self.beta * nmismatch)
-        logging.info('atomic number score from %d mismatches is %f' %(nmismatch,an_score))
+        logging.info('atomic number score from %d mismatches is %f', nmismatch, an_score)
         return an_score
 
+    def hybridization_rule_raw(self):
+        """
+        The raw mismatch count behind hybridization_rule, before the
+        penalty weighting
+        """
+        # Compare the cached hybridization states of all mapped pairs as
+        # boolean masks rather than re-deriving them atom by atom
+        hybi = self._moli_hyb[self._to_moli]
+        hybj = self._molj_hyb[self._to_molj]
+        ai = self._z_i[self._to_moli]
+        aj = self._z_j[self._to_molj]
+
+        if _hybridization_mismatch is not None:
+            mismatch = _hybridization_mismatch(hybi, hybj, ai, aj)
+        else:
+            mismatch = hybi != hybj
+
+            # Allow Nsp3 to match Nsp2, otherwise guanidines etc become painful.
+            # The hybridization values are 1 (sp), 2 (sp2) or 3 (sp3), so >= 2
+            # is the same as 'in [2, 3]'
+            mismatch &= ~((ai == 7) & (aj == 7) & (hybi >= 2) & (hybj >= 2))
+
+        nmismatch = int(mismatch.sum())
+        for k in np.nonzero(mismatch)[0].tolist():
+            logging.info("Hybridization mismatch %d %s %d vs %d %s %d",
+                         self._to_moli[k],
+                         self._moli_noh.GetAtomWithIdx(int(self._to_moli[k])).GetSymbol(),
+                         hybi[k],
+                         self._to_molj[k],
+                         self._molj_noh.GetAtomWithIdx(int(self._to_molj[k])).GetSymbol(),
+                         hybj[k])
+
+        return nmismatch
+
     # Hybridization rule
     def hybridization_rule(self, penalty_weight = 1.5):
 
@@ -945,28 +1455,36 @@ class MCS(object):
         mismatched atoms at a weight of (1-penalty_weight)
 
         """
-        nmismatch=0
-        for at in self.mcs_mol.GetAtoms():
-            moli_idx = int(at.GetProp('to_moli'))
-            molj_idx = int(at.GetProp('to_molj'))
-            moli_a = self._moli_noh.GetAtoms()[moli_idx]
-            molj_a = self._molj_noh.GetAtoms()[molj_idx]
+        nmismatch = self.hybridization_rule_raw()
+        hyb_score =  math.exp(-1 * self.beta * nmismatch * penalty_weight)
+        logging.info('hybridization score from %d mismatches is %f', nmismatch, hyb_score)
+        return hyb_score
+
 
-            hybi = atom_hybridization(moli_a)
-            hybj = atom_hybridization(molj_a)
-            mismatch= hybi != hybj
+    def sulfonamides_rule_raw(self):
+        """
+        The raw failure count (0 or 1) behind sulfonamides_rule, before
+        the penalty weighting
+        """
 
-            # Allow Nsp3 to match Nsp2, otherwise guanidines etc become painful
-            if moli_a.GetAtomicNum()==7 and molj_a.GetAtomicNum()==7 and (hybi in [2,3]) and hybj in [2,3]: mismatch=False
+        def adds_sulfonamide(mol):
+            """
+            Returns true if the removal of the MCS from the provided molecule
+            leaves a sulfonamide
+            """
 
-            if mismatch:
-                nmismatch+=1
-                logging.info("Hybridization mismatch %d %s %d vs %d %s %d",moli_a.GetIdx(),moli_a.GetSymbol(),hybi,molj_a.GetIdx(),molj_a.GetSymbol(),hybj)
+            # Cheap screen first: anything left after deleting the MCS is
+            # a piece of the whole molecule, so no sulfonamide here means
+            # no sulfonamide in the remainder either
+            if not mol.HasSubstructMatch(_SMARTS_SULFONAMIDE):
+                return False
 
-        hyb_score =  math.exp(-1 * self.beta * nmismatch * penalty_weight)
-        logging.info('hybridization score from %d mismatches is %f' %(nmismatch,hyb_score))
-        return hyb_score
+            rwm = self._strip_mcs(mol)
+            return rwm.HasSubstructMatch(_SMARTS_SULFONAMIDE)
 
+        fail = 1 if (adds_sulfonamide(self._moli_noh)) else 0
+        fail = 1 if (adds_sulfonamide(self._molj_noh)) else fail
+        return fail
 
     # Sulfonamides rule
     def sulfonamides_rule(self, penalty=4):
@@ -983,24 +1501,34 @@ class MCS(object):
 
         """
 
-        def adds_sulfonamide(mol):
+        fail = self.sulfonamides_rule_raw()
+        sulf_score =  math.exp(-1 * self.beta * fail * penalty)
+        logging.info('sulfonamide score is %f', sulf_score)
+        return sulf_score
+
+    def heterocycles_rule_raw(self):
+        """
+        The raw failure count (0 or 1) behind heterocycles_rule, before
+        the penalty weighting
+        """
+
+        def adds_heterocycle(mol):
             """
             Returns true if the removal of the MCS from the provided molecule
-            leaves a sulfonamide
+            leaves a heterocycle
             """
 
-            if not mol.HasSubstructMatch(self.mcs_mol):
-                raise ValueError('RDkit MCS Subgraph molecule search failed in sulfonamide check')
-
+            # Cheap screen first, as in adds_sulfonamide: a heterocycle
+            # in the remainder must already be present in the molecule
+            if not any(mol.HasSubstructMatch(p) for p in _HET_PATTERNS):
+                return False
 
-            rwm=rdmolops.DeleteSubstructs(mol, self.mcs_mol)
-            return rwm.HasSubstructMatch(Chem.MolFromSmarts('S(=O)(=O)N'))
+            rwm = self._strip_mcs(mol)
+            return any(rwm.HasSubstructMatch(p) for p in _HET_PATTERNS)
 
-        fail = 1 if (adds_sulfonamide(self._moli_noh)) else 0
-        fail = 1 if (adds_sulfonamide(self._molj_noh)) else fail
-        sulf_score =  math.exp(-1 * self.beta * fail * penalty)
-        logging.info('sulfonamide score is %f' %(sulf_score))
-        return sulf_score
+        fail = 1 if (adds_heterocycle(self._moli_noh)) else 0
+        fail = 1 if (adds_heterocycle(self._molj_noh)) else fail
+        return fail
 
     # Heterocycles rule
     def heterocycles_rule(self, penalty=4):
@@ -1018,31 +1546,42 @@ class MCS(object):
 
         """
 
-        def adds_heterocycle(mol):
-            """
-            Returns true if the removal of the MCS from the provided molecule
-            leaves a sulfonamide
-            """
-
-            if not mol.HasSubstructMatch(self.mcs_mol):
-                raise ValueError('RDkit MCS Subgraph molecule search failed in sulfonamide check')
+        fail = self.heterocycles_rule_raw()
+        het_score = math.exp(-1 * self.beta * fail * penalty)
+        logging.info('heterocycle score is %f', het_score)
+        return het_score
 
+    def transmuting_methyl_into_ring_rule_raw(self):
+        """
+        The raw failure count (0 or 1) behind
+        transmuting_methyl_into_ring_rule, before the penalty weighting
+        """
+        moli=self._moli_noh
+        molj=self._molj_noh
 
-            rwm=rdmolops.DeleteSubstructs(mol, self.mcs_mol)
-            # Only picking up N/C containing heterocycles - odd cases like pyran derivatives are not caught
-            grow6mheterocycle =  rwm.HasSubstructMatch(Chem.MolFromSmarts('[n]1[c,n][c,n][c,n][c,n][c,n]1'))
+        # The cached MCS match and membership masks, so finding the
+        # bonds that leave the MCS is an array lookup on the cached
+        # adjacency lists rather than a scan over every bond per MCS atom
+        moli_sub = self._moli_sub
+        molj_sub = self._molj_sub
+        maski = self._moli_sub_mask
+        maskj = self._molj_sub_mask
 
-            # Note that growing pyrrole, furan or thiophene is allowed
-            grow5mheterocycle =  rwm.HasSubstructMatch(Chem.MolFromSmarts('[o,n,s]1[n][c,n][c,n][c,n]1'))
-            grow5mheterocycle |=  rwm.HasSubstructMatch(Chem.MolFromSmarts('[o,n,s]1[c,n][n][c,n][c,n]1'))
-            return (grow6mheterocycle | grow5mheterocycle)
+        for i in range(0,len(moli_sub)):
+            # Atoms bonded to this MCS atom which are not in the MCS
+            nbrs_i = self._moli_neighbors[moli_sub[i]]
+            edge_bondsi = nbrs_i[~maski[nbrs_i]]
+            nbrs_j = self._molj_neighbors[molj_sub[i]]
+            edge_bondsj = nbrs_j[~maskj[nbrs_j]]
 
+            if edge_bondsi.size and edge_bondsj.size:
+                if (self._moli_inring[edge_bondsi][:, None]
+                        ^ self._molj_inring[edge_bondsj][None, :]).any():
+                    # One violation is enough to fail the rule, so don't
+                    # bother scanning the remaining MCS atoms
+                    return 1
 
-        fail = 1 if (adds_heterocycle(self._moli_noh)) else 0
-        fail = 1 if (adds_heterocycle(self._molj_noh)) else fail
-        het_score = math.exp(-1 * self.beta * fail * penalty)
-        logging.info('heterocycle score is %f' %(het_score))
-        return het_score
+        return 0
 
     def transmuting_methyl_into_ring_rule(self, penalty=6):
 
@@ -1056,31 +1595,9 @@ class MCS(object):
 
 
         """
-        moli=self._moli_noh
-        molj=self._molj_noh
-
-        # Get list of bonds in mol i and j that go from the MCS to a non-MCS atom,
-        # arranged in tuples with the index of the MCS atom
-        moli_sub = moli.GetSubstructMatch(self.mcs_mol)
-        molj_sub = molj.GetSubstructMatch(self.mcs_mol)
-
-        is_bad=False
-
-        for i in range(0,len(moli_sub)):
-            edge_bondsi = [ b.GetBeginAtomIdx() for b in moli.GetBonds() if (b.GetEndAtomIdx()==moli_sub[i] and not b.GetBeginAtomIdx() in moli_sub) ]
-            edge_bondsi += [ b.GetEndAtomIdx() for b in moli.GetBonds() if (b.GetBeginAtomIdx()==moli_sub[i] and not b.GetEndAtomIdx() in moli_sub) ]
-            edge_bondsj = [ b.GetBeginAtomIdx() for b in molj.GetBonds() if (b.GetEndAtomIdx()==molj_sub[i] and not b.GetBeginAtomIdx() in molj_sub) ]
-            edge_bondsj += [ b.GetEndAtomIdx() for b in molj.GetBonds() if (b.GetBeginAtomIdx()==molj_sub[i] and not b.GetEndAtomIdx() in molj_sub) ]
-            #print("Atom",i,"index",moli_sub[i],"edge atoms on mol 1 are",edge_bondsi);
-            #print("Atom",i,"index",molj_sub[i],"edge atoms on mol 2 are",edge_bondsj);
-
-            for edgeAtom_i in edge_bondsi:
-                for edgeAtom_j in edge_bondsj:
-                    if (moli.GetAtomWithIdx(edgeAtom_i).IsInRing() ^ molj.GetAtomWithIdx(edgeAtom_j).IsInRing()):
-                        is_bad=True
-
-        mescore = math.exp(-1 * self.beta * penalty) if is_bad else 1
-        logging.info('methyl-to-ring transformation score is %f' %(mescore))
+        fail = self.transmuting_methyl_into_ring_rule_raw()
+        mescore = math.exp(-1 * self.beta * fail * penalty)
+        logging.info('methyl-to-ring transformation score is %f', mescore)
         return mescore
 
     def transmuting_ring_sizes_rule(self):
@@ -1095,50 +1612,74 @@ class MCS(object):
         moli=self._moli_noh
         molj=self._molj_noh
 
-        # Get list of bonds in mol i and j that go from the MCS to a non-MCS atom,
-        # arranged in tuples with the index of the MCS atom
-        moli_sub = moli.GetSubstructMatch(self.mcs_mol)
-        molj_sub = molj.GetSubstructMatch(self.mcs_mol)
-
-        is_bad=False
+        # The cached MCS match and membership masks, as in
+        # transmuting_methyl_into_ring_rule
+        moli_sub = self._moli_sub
+        molj_sub = self._molj_sub
+        maski = self._moli_sub_mask
+        maskj = self._molj_sub_mask
 
         for i in range(0,len(moli_sub)):
-            edge_bondsi = [b.GetBeginAtomIdx() for b in moli.GetBonds()
-                           if (b.GetEndAtomIdx() == moli_sub[i] and not b.GetBeginAtomIdx() in moli_sub)]
-            edge_bondsi += [b.GetEndAtomIdx() for b in moli.GetBonds()
-                            if (b.GetBeginAtomIdx() == moli_sub[i] and not b.GetEndAtomIdx() in moli_sub)]
-            edge_bondsj = [b.GetBeginAtomIdx() for b in molj.GetBonds()
-                           if (b.GetEndAtomIdx() == molj_sub[i] and not b.GetBeginAtomIdx() in molj_sub)]
-            edge_bondsj += [b.GetEndAtomIdx() for b in molj.GetBonds()
-                            if (b.GetBeginAtomIdx() == molj_sub[i] and not b.GetEndAtomIdx() in molj_sub)]
-            #print("Atom",i,"index",moli_sub[i],"edge atoms on mol 1 are",edge_bondsi);
-            #print("Atom",i,"index",molj_sub[i],"edge atoms on mol 2 are",edge_bondsj);
-
-            for edgeAtom_i in edge_bondsi:
-                for edgeAtom_j in edge_bondsj:
-                    #print("Checking ring for atom",edgeAtom_i,edgeAtom_j,moli.GetAtomWithIdx(edgeAtom_i).IsInRing(),molj.GetAtomWithIdx(edgeAtom_j).IsInRing())
-                    if (moli.GetAtomWithIdx(edgeAtom_i).IsInRing() and molj.GetAtomWithIdx(edgeAtom_j).IsInRing()):
-                        for ring_size in range(3,8):
-                            if (moli.GetAtomWithIdx(edgeAtom_i).IsInRingSize(ring_size) ^ molj.GetAtomWithIdx(edgeAtom_j).IsInRingSize(ring_size)):
-                                logging.info('tRansforming ring sizes score is 0 based on atom %d in moli and %d in molj' %(edgeAtom_i,edgeAtom_j))
-                                is_bad=True
-                            if (moli.GetAtomWithIdx(edgeAtom_i).IsInRingSize(ring_size) or molj.GetAtomWithIdx(edgeAtom_j).IsInRingSize(ring_size)):
-                                break
-
-        return 0.1 if is_bad else 1
+            # Atoms bonded to this MCS atom which are not in the MCS
+            nbrs_i = self._moli_neighbors[moli_sub[i]]
+            edge_bondsi = nbrs_i[~maski[nbrs_i]]
+            nbrs_j = self._molj_neighbors[molj_sub[i]]
+            edge_bondsj = nbrs_j[~maskj[nbrs_j]]
+
+            for edgeAtom_i in edge_bondsi.tolist():
+                for edgeAtom_j in edge_bondsj.tolist():
+                    if (self._moli_inring[edgeAtom_i] and self._molj_inring[edgeAtom_j]):
+                        # The atoms' smallest ring sizes (in the 3..7
+                        # range) differ iff the lowest set bits of their
+                        # ring masks differ. Both masks zero means both
+                        # smallest rings are 8+, which is not flagged,
+                        # matching the old scan over IsInRingSize(3..7)
+                        mask_i = int(self._moli_ringmask[edgeAtom_i])
+                        mask_j = int(self._molj_ringmask[edgeAtom_j])
+                        if (mask_i & -mask_i) != (mask_j & -mask_j):
+                            logging.info('tRansforming ring sizes score is 0 based on atom %d in moli and %d in molj', edgeAtom_i, edgeAtom_j)
+                            # The first violation decides the score
+                            return 0.1
+
+        return 1
+
+    @staticmethod
+    def exp_scores(raws, beta=0.1):
+        """
+        Convert a sequence of raw rule accumulators (as returned by the
+        *_raw rule variants, with any penalty weights already applied)
+        into scores with a single vectorized exponential. Useful when
+        accumulating raw values over a whole score matrix and scoring
+        them in one go
+
+        Parameters
+        ----------
+        raws : sequence of float
+            the raw accumulator values
+        beta : float
+            the atom penalty scaling, matching self.beta
+
+        Returns
+        -------
+        scores : numpy array of float
+            exp(-beta * raws)
+        """
+        return np.exp(-beta * np.asarray(raws, dtype=float))
+
+    def get_map(self):
+        '''
+        Returns the current MCS mapping between the heavy-atom-only
+        molecules as a list of (moli_idx, molj_idx) tuples, in MCS atom
+        order
+        '''
+        return [tuple(map(int, row)) for row in self._map_moli_molj]
 
     def heavy_atom_mcs_map(self):
         '''
         Returns a list of tuples mapping atoms from moli to molj
         Heavy atoms only, returned sorted by first index
         '''
-        maplist=[]
-        for at in self.mcs_mol.GetAtoms():
-            moli_idx = int(at.GetProp('to_moli'))
-            molj_idx = int(at.GetProp('to_molj'))
-            maplist.append((moli_idx,molj_idx))
-        maplist.sort()
-        return maplist
+        return sorted(map(tuple, self._map_moli_molj.tolist()))
 
     def heavy_atom_match_list(self):
         '''
@@ -1146,7 +1687,7 @@ class MCS(object):
           atom_m1:atom_m2,atom_m1:atom_m2,...
         Heavy atoms only
         '''
-        return ",".join([str(i)+":"+str(j) for (i,j) in self.heavy_atom_mcs_map()])
+        return ",".join(f"{i}:{j}" for (i,j) in self.heavy_atom_mcs_map())
 
     def all_atom_match_list(self):
         '''
@@ -1157,24 +1698,27 @@ class MCS(object):
         are mapped correctly.
         '''
 
-        def get_attached_atoms_not_in_mcs(mol,i):
-            ''' Get atoms attached to atom i which are not in the MCS '''
-            attached=[]
-            for b in mol.GetBonds():
-                if b.GetEndAtomIdx()==i or b.GetBeginAtomIdx()==i:
-                    j=b.GetEndAtomIdx()
-                    if (j==i):
-                        j=b.GetBeginAtomIdx()
-                    # OK, so j is the atom at the other end of the bond atom atom i. Is it in the MCS?
-                    inMCS = mol.GetAtomWithIdx(j).HasProp('to_mcs')
-                    if not inMCS:
-                        attached.append(j)
-            return attached
-
-
         moli=self.moli
         molj=self.molj
 
+        # For every atom, the attached atoms which are not in the MCS
+        # (per the index dicts built in map_mcs_mol), precomputed in one
+        # traversal per molecule rather than inside the matching loop
+        moli_attached = [[a.GetIdx() for a in at.GetNeighbors()
+                          if a.GetIdx() not in self._moli_to_mcs]
+                         for at in moli.GetAtoms()]
+        molj_attached = [[a.GetIdx() for a in at.GetNeighbors()
+                          if a.GetIdx() not in self._molj_to_mcs]
+                         for at in molj.GetAtoms()]
+
+        # Hoist the conformers and atomic numbers out of the hydrogen
+        # matching loops below - each GetConformer()/GetAtomWithIdx()
+        # call is a fresh RDKit proxy
+        conf_i = moli.GetConformer()
+        conf_j = molj.GetConformer()
+        z_i = [a.GetAtomicNum() for a in moli.GetAtoms()]
+        z_j = [a.GetAtomicNum() for a in molj.GetAtoms()]
+
         heavy_maplist = self.heavy_atom_mcs_map()
 
         maplist = []
@@ -1191,8 +1735,9 @@ class MCS(object):
         for at in self.mcs_mol.GetAtoms():
             moli_idx = int(at.GetProp('to_moli_all'))
             molj_idx = int(at.GetProp('to_molj_all'))
-            attached_i = get_attached_atoms_not_in_mcs(moli,moli_idx)
-            attached_j = get_attached_atoms_not_in_mcs(molj,molj_idx)
+            # Copies, as the matching loop consumes the lists
+            attached_i = list(moli_attached[moli_idx])
+            attached_j = list(molj_attached[molj_idx])
 
             # Now, we need to match these up, with the caveat that we *must* not match
             # a heavy to a heavy (as if we were allowed to match these, then they would be
@@ -1208,11 +1753,11 @@ class MCS(object):
                 hidx_j=-1
                 best_dist=10000
                 for ai in attached_i:
-                    if moli.GetAtomWithIdx(ai).GetAtomicNum()==1:
+                    if z_i[ai]==1:
                         for aj in attached_j:
-                            if molj.GetAtomWithIdx(aj).GetAtomicNum()==1:
-                                dist = (moli.GetConformer().GetAtomPosition(ai)
-                                      - molj.GetConformer().GetAtomPosition(aj)).Length()
+                            if z_j[aj]==1:
+                                dist = (conf_i.GetAtomPosition(ai)
+                                      - conf_j.GetAtomPosition(aj)).Length()
                                 if (dist < best_dist or not self.options['threed']):
                                     hidx_i=ai
                                     hidx_j=aj
@@ -1221,9 +1766,9 @@ class MCS(object):
                     # OK, no hydrogen-hydrogen matches left. Try to match a hydrogen to a non-hydrogen
                     for ai in attached_i:
                         for aj in attached_j:
-                            if moli.GetAtomWithIdx(ai).GetAtomicNum()==1 or molj.GetAtomWithIdx(aj).GetAtomicNum()==1:
-                                dist = (moli.GetConformer().GetAtomPosition(ai)
-                                      - molj.GetConformer().GetAtomPosition(aj)).Length()
+                            if z_i[ai]==1 or z_j[aj]==1:
+                                dist = (conf_i.GetAtomPosition(ai)
+                                      - conf_j.GetAtomPosition(aj)).Length()
                                 if (dist < best_dist or not self.options['threed']):
                                     hidx_i=ai
                                     hidx_j=aj
@@ -1302,7 +1847,7 @@ if "__main__" == __name__:
 
     # MCS calculation
     try:
-        MC = MCS(mola, molb, time=20, verbose='pedantic', max3d=5, threed=True)
+        MC = MCS.get_or_build(mola, molb, time=20, verbose='pedantic', max3d=5, threed=True)
         #MC = MCS(mola, molb, argparse.Namespace(time=20, verbose='info', max3d=0, threed=False))
         #MC = MCS(mola, molb)
     except Exception:
@@ -1333,8 +1878,8 @@ if "__main__" == __name__:
     for at in MC.mcs_mol.GetAtoms():
         moli_idx = int(at.GetProp('to_moli'))
         molj_idx = int(at.GetProp('to_molj'))
-        moli_a = mola.GetAtoms()[moli_idx]
-        molj_a = molb.GetAtoms()[molj_idx]
+        moli_a = mola.GetAtomWithIdx(moli_idx)
+        molj_a = molb.GetAtomWithIdx(molj_idx)
         print("MCS match: ",moli_idx,moli_a.GetAtomicNum(),molj_idx,molj_a.GetAtomicNum())
 
     print("hybridization change:",hybrid)
@@ -0,0 +1,42 @@
+"""
+Tests for the bit-packed fingerprint helpers
+"""
+import numpy as np
+import pytest
+from rdkit import Chem, DataStructs
+from rdkit.Chem import AllChem
+
+from lomap import fp
+
+SMILES = ['Cc1ccccc1', 'CC1CCCCC1', 'Cc1ccc2ccccc2c1', 'Oc1ccc2ccccc2c1']
+
+
+@pytest.fixture(scope='session')
+def mols():
+    return [Chem.MolFromSmiles(s) for s in SMILES]
+
+
+def test_pack_fingerprints_shape(mols):
+    packed = fp.pack_fingerprints(mols)
+
+    assert packed.shape == (len(mols), 1024 // 64)
+    assert packed.dtype == np.uint64
+
+
+def test_pack_fingerprints_bad_nbits(mols):
+    with pytest.raises(ValueError):
+        fp.pack_fingerprints(mols, nbits=100)
+
+
+def test_bulk_tanimoto_matches_rdkit(mols):
+    packed = fp.pack_fingerprints(mols)
+    sims = fp.bulk_tanimoto(packed)
+
+    fps = [AllChem.GetMorganFingerprintAsBitVect(m, 2, nBits=1024)
+           for m in mols]
+
+    assert sims.shape == (len(mols), len(mols))
+    for i in range(len(mols)):
+        for j in range(len(mols)):
+            ref = DataStructs.FingerprintSimilarity(fps[i], fps[j])
+            assert sims[i, j] == pytest.approx(ref)
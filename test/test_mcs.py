@@ -291,3 +291,40 @@ def test_toluene_to_other_explicit(regression_mappings_explicit):
     mapping = [tuple(map(int, row.split(':'))) for row in mapping.split(',')]
 
     assert sorted(mapping) == ref_mapping
+
+
+def test_exp_scores_matches_rules(toluene, methylnaphthalene):
+    mapper = mcs.MCS(Chem.Mol(toluene), Chem.Mol(methylnaphthalene))
+
+    raws = [mapper.mcsr_raw(), mapper.atomic_number_rule_raw()]
+    scores = mcs.MCS.exp_scores(raws)
+
+    assert scores == pytest.approx([mapper.mcsr(),
+                                    mapper.atomic_number_rule()])
+
+
+def test_get_or_build_caches(toluene, methylcyclohexane):
+    first = mcs.MCS.get_or_build(Chem.Mol(toluene), Chem.Mol(methylcyclohexane))
+    again = mcs.MCS.get_or_build(Chem.Mol(toluene), Chem.Mol(methylcyclohexane))
+    other = mcs.MCS.get_or_build(Chem.Mol(toluene), Chem.Mol(methylcyclohexane),
+                                 time=10)
+
+    assert again is first
+    assert other is not first
+
+    ref = mcs.MCS(Chem.Mol(toluene), Chem.Mol(methylcyclohexane))
+    assert first.heavy_atom_mcs_map() == ref.heavy_atom_mcs_map()
+
+
+def test_build_many(toluene, methylcyclohexane, methylnaphthalene):
+    pairs = [(toluene, methylcyclohexane), (toluene, methylnaphthalene)]
+
+    results = mcs.MCS.build_many(pairs, n_jobs=2)
+
+    assert len(results) == 2
+    for (moli, molj), result in zip(pairs, results):
+        assert 'error' not in result
+        ref = mcs.MCS(Chem.Mol(moli), Chem.Mol(molj))
+        assert result['heavy_atom_match_list'] == ref.heavy_atom_match_list()
+        assert result['all_atom_match_list'] == ref.all_atom_match_list()
+        assert result['mcsr'] == pytest.approx(ref.mcsr())